@@ -7,20 +7,137 @@
 Needs to be refactored into smaller functions."""
 
 from __future__ import with_statement
+import collections
+import hashlib
+import io
+import multiprocessing
+import Queue
 import time
-import datetime
 import syslog
+import os
 import os.path
 
+# NumPy is optional. If it is available, vector arithmetic is done with fast
+# C loops instead of Python list comprehensions.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 import weeplot.genplot
 import weeplot.utilities
 import weeutil.weeutil
+import weewx.manager
 import weewx.reportengine
 import weewx.units
 from weeutil.config import search_up
 from weeutil.weeutil import to_bool, to_int, to_float
 from weewx.units import ValueTuple
 
+def _tobgr(x):
+    """Memoized version of weeplot.utilities.tobgr.
+
+    The same handful of color strings shows up over and over across plots and
+    report runs, so the second occurrence becomes a dictionary hit instead of
+    a string parse."""
+    try:
+        return _tobgr.cache[x]
+    except TypeError:
+        # Unhashable input. Parse it directly.
+        return weeplot.utilities.tobgr(x)
+    except KeyError:
+        pass
+    v = weeplot.utilities.tobgr(x)
+    if len(_tobgr.cache) < 512:
+        _tobgr.cache[x] = v
+    return v
+_tobgr.cache = {}
+
+def _mtime_or_none(path):
+    """File modification time, or None if unavailable."""
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return None
+
+# Memoized accumulateLeaves results, keyed by report, config file mtimes, and
+# section path. See ImageGenerator._accumulateLeaves.
+_leaf_cache = {}
+
+# A plot section flattened into plain data: the accumulated plot options and
+# the pre-resolved configs of its lines.
+_PlotJob = collections.namedtuple('_PlotJob', ['plot_options', 'line_cfgs'])
+
+# Compiled plot jobs, keyed by the same (report, config mtimes) prefix as the
+# leaf cache. See ImageGenerator._compilePlotJobs.
+_compiled_jobs_cache = {}
+
+# Digest of the PNG bytes last written to each image file, so a render that
+# produced identical bytes can skip the disk write:
+_last_png_hash = {}
+
+def _bottom_label(label_format, ts):
+    """Memoized strftime for the bottom label.
+
+    Within one report run every plot usually shares the same generation
+    timestamp and label format, so the timezone lookup and formatting are
+    done once instead of once per plot."""
+    key = (label_format, ts)
+    try:
+        return _bottom_label.cache[key]
+    except KeyError:
+        pass
+    label = time.strftime(label_format, time.localtime(ts))
+    if len(_bottom_label.cache) > 64:
+        _bottom_label.cache.clear()
+    _bottom_label.cache[key] = label
+    return label
+_bottom_label.cache = {}
+
+def _maybe_tobgr(color_str):
+    """Parse a color option, passing None straight through."""
+    return _tobgr(color_str) if color_str is not None else None
+
+# Per-plot-type option preparation, dispatched by plot type instead of a
+# branch ladder. Each handler returns (vector_rotate, gap_fraction).
+
+def _prep_vector(line_options):
+    vector_rotate_str = line_options.get('vector_rotate')
+    vector_rotate = -float(vector_rotate_str) if vector_rotate_str is not None else None
+    return vector_rotate, None
+
+def _prep_line(line_options):
+    gap_fraction = to_float(line_options.get('line_gap_fraction'))
+    if gap_fraction is not None:
+        if not 0 < gap_fraction < 1:
+            syslog.syslog(syslog.LOG_ERR, "imagegenerator: Gap fraction %5.3f outside range 0 to 1. Ignored." % gap_fraction)
+            gap_fraction = None
+    return None, gap_fraction
+
+def _prep_default(line_options):
+    return None, None
+
+_PLOT_TYPE_PREP = {'vector': _prep_vector,
+                   'line'  : _prep_line,
+                   'bar'   : _prep_default}
+
+# All the options for a single plot line, resolved and coerced exactly once:
+_LineConfig = collections.namedtuple('_LineConfig', ['var_type',
+                                                     'binding',
+                                                     'aggregate_type',
+                                                     'aggregate_interval',
+                                                     'plot_type',
+                                                     'unit_label',
+                                                     'label',
+                                                     'color',
+                                                     'fill_color',
+                                                     'width',
+                                                     'line_type',
+                                                     'marker_type',
+                                                     'marker_size',
+                                                     'vector_rotate',
+                                                     'gap_fraction'])
+
 # =============================================================================
 #                    Class ImageGenerator
 # =============================================================================
@@ -48,6 +165,72 @@ class ImageGenerator(weewx.reportengine.ReportGenerator):
             self.skin_dict['skin'])
         # ensure that we are in a consistent right location
         os.chdir(self.image_dict['skin_dir'])
+        # directories known to exist, so mkdir is attempted only once each:
+        self._dirs_made = set()
+        # Render signatures are cached outside of HTML_ROOT, so the FTP and
+        # rsync generators, which upload HTML_ROOT wholesale, never publish
+        # them:
+        self._sig_dir = os.path.join(self.config_dict['WEEWX_ROOT'],
+                                     'cache',
+                                     self.skin_dict['REPORT_NAME'])
+        # The merged option dict of a section can be reused across report
+        # cycles for as long as neither weewx.conf nor skin.conf changes.
+        # This is the cache key prefix that enforces that.
+        self._leaf_key_prefix = (
+            self.skin_dict.get('REPORT_NAME'),
+            _mtime_or_none(getattr(self.config_dict, 'filename', None)),
+            _mtime_or_none(os.path.join(self.image_dict['skin_dir'], 'skin.conf')))
+        # Flatten the [ImageGenerator] tree into pre-resolved plot jobs.
+        # Compiled jobs stay valid until a configuration file changes, which
+        # also changes the key.
+        if self._leaf_key_prefix not in _compiled_jobs_cache:
+            if len(_compiled_jobs_cache) > 8:
+                _compiled_jobs_cache.clear()
+            _compiled_jobs_cache[self._leaf_key_prefix] = self._compilePlotJobs()
+        self._plot_jobs = _compiled_jobs_cache[self._leaf_key_prefix]
+
+    def _compilePlotJobs(self):
+        """Walk the [ImageGenerator] tree once, resolving the options of
+        every plot and every line.
+
+        Returns an ordered dict mapping (timespan, plotname) to a _PlotJob.
+        genImages then iterates plain structures instead of re-walking the
+        ConfigObj tree (and re-coercing every option) each report cycle."""
+        plot_jobs = collections.OrderedDict()
+        for timespan in self.image_dict.sections:
+            for plotname in self.image_dict[timespan].sections:
+                plot_options = self._accumulateLeaves(
+                    self.image_dict[timespan][plotname],
+                    '%s/%s' % (timespan, plotname))
+                line_cfgs = []
+                for line_name in self.image_dict[timespan][plotname].sections:
+                    line_options = self._accumulateLeaves(
+                        self.image_dict[timespan][plotname][line_name],
+                        '%s/%s/%s' % (timespan, plotname, line_name))
+                    cfg = self._build_line_config(line_name, line_options)
+                    if cfg is None:
+                        continue
+                    line_cfgs.append(cfg)
+                plot_jobs[(timespan, plotname)] = _PlotJob(plot_options, line_cfgs)
+        return plot_jobs
+
+    def _accumulateLeaves(self, section, path):
+        """Memoized version of weeutil.weeutil.accumulateLeaves.
+
+        The skin configuration is re-read at every report cycle, but almost
+        never changes, so the accumulated option dict for a section (named by
+        its path, e.g. 'day/daytempdew/dewpoint') is reused until one of the
+        configuration files is touched."""
+        key = self._leaf_key_prefix + (path,)
+        try:
+            return _leaf_cache[key]
+        except KeyError:
+            pass
+        if len(_leaf_cache) > 512:
+            _leaf_cache.clear()
+        result = weeutil.weeutil.accumulateLeaves(section)
+        _leaf_cache[key] = result
+        return result
 
     def genImages(self, gen_ts):
         """Generate the images.
@@ -60,227 +243,504 @@ class ImageGenerator(weewx.reportengine.ReportGenerator):
         to use the time of the last record in the database.]
         """
         t1 = time.time()
-        ngen = 0
 
         # determine how much logging is desired
         log_success = to_bool(search_up(self.image_dict, 'log_success', True))
 
-        # Loop over each time span class (day, week, month, etc.):
-        for timespan in self.image_dict.sections:
+        # First pass: assemble the list of plots that actually have to be
+        # rendered. Each is independent of the others (its own output file and
+        # TimePlot instance), so the rendering work can be farmed out to
+        # worker processes.
+        jobs = []
 
-            # Now, loop over all plot names in this time span class:
-            for plotname in self.image_dict[timespan].sections:
+        # One lastGoodStamp() lookup per binding for the whole report,
+        # instead of one per plot. The manager lookup itself is already
+        # cached inside the DBBinder:
+        last_good = {}
 
-                # Accumulate all options from parent nodes:
-                plot_options = weeutil.weeutil.accumulateLeaves(
-                    self.image_dict[timespan][plotname])
+        # Loop over each pre-compiled plot job, in skin order. The double
+        # walk over time span classes (day, week, month, etc.) and plot
+        # names was flattened at setup() time.
+        for (timespan, plotname) in self._plot_jobs:
 
-                plotgen_ts = gen_ts
-                if not plotgen_ts:
-                    binding = plot_options['data_binding']
-                    archive = self.db_binder.get_manager(binding)
-                    plotgen_ts = archive.lastGoodStamp()
-                    if not plotgen_ts:
-                        plotgen_ts = time.time()
-
-                image_root = os.path.join(self.config_dict['WEEWX_ROOT'],
-                                          plot_options['HTML_ROOT'])
-                # Get the path that the image is going to be saved to:
-                img_file = os.path.join(image_root, '%s.png' % plotname)
-
-                ai = to_int(plot_options.get('aggregate_interval'))
-                # Check whether this plot needs to be done at all:
-                if skipThisPlot(plotgen_ts, ai, img_file):
-                    continue
-
-                # skip image files that are fresh, but only if staleness is defined
-                stale = to_int(plot_options.get('stale_age'))
-                if stale is not None:
-                    t_now = time.time()
-                    try:
-                        last_mod = os.path.getmtime(img_file)
-                        if t_now - last_mod < stale:
-                            syslog.syslog(syslog.LOG_DEBUG, "imagegenerator: Skip '%s': last_mod=%s age=%s stale=%s" % (img_file, last_mod, t_now - last_mod, stale))
-                            continue
-                    except os.error:
-                        pass
+            job = self._plot_jobs[(timespan, plotname)]
+            plot_options = job.plot_options
+
+            binding = plot_options['data_binding']
+            if binding not in last_good:
+                last_good[binding] = self.db_binder.get_manager(binding).lastGoodStamp()
 
-                # Create the subdirectory that the image is to be put in.
-                # Wrap in a try block in case it already exists.
+            plotgen_ts = gen_ts
+            if not plotgen_ts:
+                plotgen_ts = last_good[binding]
+                if not plotgen_ts:
+                    plotgen_ts = time.time()
+
+            image_root = os.path.join(self.config_dict['WEEWX_ROOT'],
+                                      plot_options['HTML_ROOT'])
+            # Get the path that the image is going to be saved to:
+            img_file = os.path.join(image_root, '%s.png' % plotname)
+
+            ai = to_int(plot_options.get('aggregate_interval'))
+            # Check whether this plot needs to be done at all:
+            if skipThisPlot(plotgen_ts, ai, img_file):
+                continue
+
+            # skip image files that are fresh, but only if staleness is defined
+            stale = to_int(plot_options.get('stale_age'))
+            if stale is not None:
+                t_now = time.time()
                 try:
-                    os.makedirs(os.path.dirname(img_file))
-                except OSError:
+                    last_mod = os.path.getmtime(img_file)
+                    if t_now - last_mod < stale:
+                        syslog.syslog(syslog.LOG_DEBUG, "imagegenerator: Skip '%s': last_mod=%s age=%s stale=%s" % (img_file, last_mod, t_now - last_mod, stale))
+                        continue
+                except os.error:
                     pass
 
-                # Create a new instance of a time plot and start adding to it
-                plot = weeplot.genplot.TimePlot(plot_options)
-
-                # Calculate a suitable min, max time for the requested time.
-                (minstamp, maxstamp, timeinc) = weeplot.utilities.scaletime(plotgen_ts - int(plot_options.get('time_length', 86400)), plotgen_ts)
-                # Override the x interval if the user has given an explicit interval:
-                timeinc_user = to_int(plot_options.get('x_interval'))
-                if timeinc_user is not None:
-                    timeinc = timeinc_user
-                plot.setXScaling((minstamp, maxstamp, timeinc))
-
-                # Set the y-scaling, using any user-supplied hints:
-                plot.setYScaling(weeutil.weeutil.convertToFloat(plot_options.get('yscale', ['None', 'None', 'None'])))
-
-                # Get a suitable bottom label:
-                bottom_label_format = plot_options.get('bottom_label_format', '%m/%d/%y %H:%M')
-                bottom_label = time.strftime(bottom_label_format, time.localtime(plotgen_ts))
-                plot.setBottomLabel(bottom_label)
-
-                # Set day/night display
-                plot.setLocation(self.stn_info.latitude_f, self.stn_info.longitude_f)
-                plot.setDayNight(to_bool(plot_options.get('show_daynight', False)),
-                                 weeplot.utilities.tobgr(plot_options.get('daynight_day_color', '0xffffff')),
-                                 weeplot.utilities.tobgr(plot_options.get('daynight_night_color', '0xf0f0f0')),
-                                 weeplot.utilities.tobgr(plot_options.get('daynight_edge_color', '0xefefef')))
-
-                # Loop over each line to be added to the plot.
-                for line_name in self.image_dict[timespan][plotname].sections:
-
-                    # Accumulate options from parent nodes.
-                    line_options = weeutil.weeutil.accumulateLeaves(self.image_dict[timespan][plotname][line_name])
-
-                    # See what SQL variable type to use for this line. By
-                    # default, use the section name.
-                    var_type = line_options.get('data_type', line_name)
-
-                    # Look for aggregation type:
-                    aggregate_type = line_options.get('aggregate_type')
-                    if aggregate_type in (None, '', 'None', 'none'):
-                        # No aggregation specified.
-                        aggregate_type = aggregate_interval = None
-                    else:
-                        try:
-                            # Aggregation specified. Get the interval.
-                            aggregate_interval = line_options.as_int('aggregate_interval')
-                        except KeyError:
-                            syslog.syslog(syslog.LOG_ERR, "imagegenerator: aggregate interval required for aggregate type %s" % aggregate_type)
-                            syslog.syslog(syslog.LOG_ERR, "imagegenerator: line type %s skipped" % var_type)
+            # Whole-plot elimination: if neither the options, nor the
+            # databases, nor the configuration files, nor the generation time
+            # have changed since the image was last rendered, the result
+            # would be identical, so skip it. Lines may draw from their own
+            # data_binding, so the newest timestamp of every binding this
+            # plot touches goes into the signature.
+            # NB: backfilling history (e.g. with wee_import) does not advance
+            # lastGoodStamp, so a backfill followed by a wee_reports run will
+            # still match the old signature. Touch weewx.conf, or clear the
+            # cache directory, to force a full regeneration.
+            plot_bindings = set([binding])
+            plot_bindings.update(cfg.binding for cfg in job.line_cfgs)
+            for b in plot_bindings:
+                if b not in last_good:
+                    last_good[b] = self.db_binder.get_manager(b).lastGoodStamp()
+            sig = hashlib.md5(('%r%r%r%r%s' % (self._leaf_key_prefix,
+                                               sorted(plot_options.items()),
+                                               self.image_dict[timespan][plotname],
+                                               sorted((b, last_good[b]) for b in plot_bindings),
+                                               plotgen_ts)).encode('utf8')).hexdigest()
+            if os.path.exists(img_file):
+                try:
+                    with open(self._sig_path(img_file)) as sf:
+                        if sf.read() == sig:
+                            syslog.syslog(syslog.LOG_DEBUG, "imagegenerator: Skip '%s': signature unchanged" % img_file)
                             continue
+                except IOError:
+                    pass
 
-                    # Now its time to find and hit the database:
-                    binding = line_options['data_binding']
-                    archive = self.db_binder.get_manager(binding)
-                    (start_vec_t, stop_vec_t, data_vec_t) = \
-                            archive.getSqlVectors((minstamp, maxstamp), var_type, aggregate_type=aggregate_type,
-                                                  aggregate_interval=aggregate_interval)
-
-                    if weewx.debug:
-                        assert(len(start_vec_t) == len(stop_vec_t))
-
-                    # Get the type of plot ("bar', 'line', or 'vector')
-                    plot_type = line_options.get('plot_type', 'line')
-
-                    if aggregate_type and aggregate_type.lower() in ('avg', 'max', 'min') and plot_type != 'bar':
-                        # Put the point in the middle of the aggregate_interval for these aggregation types
-                        start_vec_t = ValueTuple([x - aggregate_interval / 2.0 for x in start_vec_t[0]],
-                                                 start_vec_t[1], start_vec_t[2])
-                        stop_vec_t = ValueTuple([x - aggregate_interval / 2.0 for x in stop_vec_t[0]],
-                                                stop_vec_t[1], stop_vec_t[2])
-
-                    # Do any necessary unit conversions:
-                    new_start_vec_t = self.converter.convert(start_vec_t)
-                    new_stop_vec_t  = self.converter.convert(stop_vec_t)
-                    new_data_vec_t = self.converter.convert(data_vec_t)
-
-                    # Add a unit label. NB: all will get overwritten except the
-                    # last. Get the label from the configuration dictionary.
-                    unit_label = line_options.get('y_label', weewx.units.get_label_string(self.formatter, self.converter, var_type))
-                    # Strip off any leading and trailing whitespace so it's
-                    # easy to center
-                    plot.setUnitLabel(unit_label.strip())
-
-                    # See if a line label has been explicitly requested:
-                    label = line_options.get('label')
-                    if not label:
-                        # No explicit label. Look up a generic one. NB: title_dict is a KeyDict which
-                        # will substitute the key if the value is not in the dictionary.
-                        label = self.title_dict[var_type]
-
-                    # See if a color has been explicitly requested.
-                    color = line_options.get('color')
-                    if color is not None: color = weeplot.utilities.tobgr(color)
-                    fill_color = line_options.get('fill_color')
-                    if fill_color is not None: fill_color = weeplot.utilities.tobgr(fill_color)
-
-                    # Get the line width, if explicitly requested.
-                    width = to_int(line_options.get('width'))
-
-                    interval_vec = None
-                    gap_fraction = None
-
-                    # Some plot types require special treatments:
-                    if plot_type == 'vector':
-                        vector_rotate_str = line_options.get('vector_rotate')
-                        vector_rotate = -float(vector_rotate_str) if vector_rotate_str is not None else None
-                    else:
-                        vector_rotate = None
-
-                        if plot_type == 'bar':
-                            interval_vec = [x[1] - x[0]for x in zip(new_start_vec_t.value, new_stop_vec_t.value)]
-                        elif plot_type == 'line':
-                            gap_fraction = to_float(line_options.get('line_gap_fraction'))
-                        if gap_fraction is not None:
-                            if not 0 < gap_fraction < 1:
-                                syslog.syslog(syslog.LOG_ERR, "imagegenerator: Gap fraction %5.3f outside range 0 to 1. Ignored." % gap_fraction)
-                                gap_fraction = None
-
-                    # Get the type of line (only 'solid' or 'none' for now)
-                    line_type = line_options.get('line_type', 'solid')
-                    if line_type.strip().lower() in ['', 'none']:
-                        line_type = None
-
-                    marker_type = line_options.get('marker_type')
-                    marker_size = to_int(line_options.get('marker_size', 8))
-                    
-                    # Add the line to the emerging plot:
-                    plot.addLine(weeplot.genplot.PlotLine(
-                        new_stop_vec_t[0], new_data_vec_t[0],
-                        label         = label,
-                        color         = color,
-                        fill_color    = fill_color,
-                        width         = width,
-                        plot_type     = plot_type,
-                        line_type     = line_type,
-                        marker_type   = marker_type,
-                        marker_size   = marker_size,
-                        bar_width     = interval_vec,
-                        vector_rotate = vector_rotate,
-                        gap_fraction  = gap_fraction))
-
-                # OK, the plot is ready. Render it onto an image
-                image = plot.render()
+            jobs.append((timespan, plotname, plotgen_ts, img_file, sig))
+
+        # Second pass: render the plots, in parallel if more than one worker
+        # has been requested. Parallel rendering is strictly opt-in: forking
+        # a multithreaded daemon is risky (a lock held by another thread at
+        # fork time stays locked forever in the child), so the default is the
+        # old serial behavior.
+        try:
+            nworkers = int(search_up(self.image_dict, 'image_workers', 1))
+        except ValueError:
+            nworkers = 1
+        nworkers = min(nworkers, len(jobs))
+        # Worker processes rely on fork(), so that the (unpicklable)
+        # generator state gets inherited. Fall back to serial elsewhere.
+        if nworkers > 1 and hasattr(os, 'fork'):
+            ngen = self._renderInParallel(jobs, nworkers)
+        else:
+            ngen = 0
+            for job in jobs:
+                ngen += self.genPlotImage(*job)
 
-                try:
-                    # Now save the image
-                    image.save(img_file)
-                    ngen += 1
-                except IOError as e:
-                    syslog.syslog(syslog.LOG_CRIT, "imagegenerator: Unable to save to file '%s' %s:" % (img_file, e))
         t2 = time.time()
 
         if log_success:
             syslog.syslog(syslog.LOG_INFO, "imagegenerator: Generated %d images for %s in %.2f seconds" % (ngen, self.skin_dict['REPORT_NAME'], t2 - t1))
 
+    def _sig_path(self, img_file):
+        """Where the render signature of an image is cached.
+
+        The file name carries a digest of the full image path, so images
+        with the same name under different HTML_ROOTs cannot collide."""
+        digest = hashlib.md5(img_file.encode('utf8')).hexdigest()[:8]
+        return os.path.join(self._sig_dir,
+                            '%s-%s.sig' % (os.path.basename(img_file), digest))
+
+    # How long to wait (in seconds) for a rendering worker before declaring
+    # it hung:
+    worker_timeout = 300.0
+
+    def _renderInParallel(self, jobs, nworkers):
+        """Render the given plot jobs using a pool of worker processes.
+
+        Returns the number of images generated."""
+        result_queue = multiprocessing.Queue()
+        workers = []
+        for i in range(nworkers):
+            # Deal the jobs out round-robin, one hand per worker:
+            p = multiprocessing.Process(target=self._plotWorker,
+                                        args=(jobs[i::nworkers], result_queue))
+            p.start()
+            workers.append(p)
+        # Each worker puts exactly one count on the queue before exiting, but
+        # a worker can also die without reporting (killed by the OOM reaper,
+        # or a crash in a C extension). Never wait on the queue alone -- that
+        # would hang the report thread, and with it all future reports. Wait
+        # on the processes, with a timeout, then collect whatever counts
+        # actually arrived.
+        for p in workers:
+            p.join(self.worker_timeout)
+            if p.is_alive():
+                syslog.syslog(syslog.LOG_ERR, "imagegenerator: Rendering worker (pid %d) hung. Terminating it." % p.pid)
+                p.terminate()
+                p.join()
+            elif p.exitcode != 0:
+                syslog.syslog(syslog.LOG_ERR, "imagegenerator: Rendering worker (pid %d) died with exit code %d" % (p.pid, p.exitcode))
+        ngen = 0
+        for _p in workers:
+            try:
+                ngen += result_queue.get(True, 1.0)
+            except Queue.Empty:
+                # A worker died before it could report its count.
+                break
+        return ngen
+
+    def _plotWorker(self, jobs, result_queue):
+        """Run in a forked child: render a list of plot jobs.
+
+        The database connections inherited from the parent are not fork-safe,
+        so open a fresh binder for this process."""
+        self.db_binder = weewx.manager.DBBinder(self.config_dict)
+        ngen = 0
+        try:
+            for job in jobs:
+                try:
+                    ngen += self.genPlotImage(*job)
+                except Exception as e:
+                    # The parent cannot see this process's stderr, so log the
+                    # failure here, then carry on with the remaining plots:
+                    syslog.syslog(syslog.LOG_ERR, "imagegenerator: Worker failed to render plot '%s': %s" % (job[1], e))
+                    weeutil.weeutil.log_traceback("        ****  ")
+        finally:
+            self.db_binder.close()
+            result_queue.put(ngen)
+
+    def _build_line_config(self, line_name, line_options):
+        """Resolve and coerce all the options for one plot line.
+
+        Returns an instance of _LineConfig, or None if the line is
+        misconfigured and should be skipped."""
+
+        # See what SQL variable type to use for this line. By
+        # default, use the section name.
+        var_type = line_options.get('data_type', line_name)
+
+        # Look for aggregation type:
+        aggregate_type = line_options.get('aggregate_type')
+        if aggregate_type in (None, '', 'None', 'none'):
+            # No aggregation specified.
+            aggregate_type = aggregate_interval = None
+        else:
+            try:
+                # Aggregation specified. Get the interval.
+                aggregate_interval = line_options.as_int('aggregate_interval')
+            except KeyError:
+                syslog.syslog(syslog.LOG_ERR, "imagegenerator: aggregate interval required for aggregate type %s" % aggregate_type)
+                syslog.syslog(syslog.LOG_ERR, "imagegenerator: line type %s skipped" % var_type)
+                return None
+
+        # Get the type of plot ("bar', 'line', or 'vector')
+        plot_type = line_options.get('plot_type', 'line')
+
+        # The unit label. Strip off any leading and trailing whitespace so
+        # it's easy to center.
+        unit_label = line_options.get('y_label', weewx.units.get_label_string(self.formatter, self.converter, var_type))
+
+        # See if a line label has been explicitly requested:
+        label = line_options.get('label')
+        if not label:
+            # No explicit label. Look up a generic one. NB: title_dict is a KeyDict which
+            # will substitute the key if the value is not in the dictionary.
+            label = self.title_dict[var_type]
+
+        # See if a color has been explicitly requested.
+        color = _maybe_tobgr(line_options.get('color'))
+        fill_color = _maybe_tobgr(line_options.get('fill_color'))
+
+        # Get the line width, if explicitly requested.
+        width = to_int(line_options.get('width'))
+
+        # Some plot types require special treatments:
+        vector_rotate, gap_fraction = \
+            _PLOT_TYPE_PREP.get(plot_type, _prep_default)(line_options)
+
+        # Get the type of line (only 'solid' or 'none' for now)
+        line_type = line_options.get('line_type', 'solid')
+        if line_type.strip().lower() in ['', 'none']:
+            line_type = None
+
+        marker_type = line_options.get('marker_type')
+        marker_size = to_int(line_options.get('marker_size', 8))
+
+        return _LineConfig(var_type=var_type,
+                           binding=line_options['data_binding'],
+                           aggregate_type=aggregate_type,
+                           aggregate_interval=aggregate_interval,
+                           plot_type=plot_type,
+                           unit_label=unit_label.strip(),
+                           label=label,
+                           color=color,
+                           fill_color=fill_color,
+                           width=width,
+                           line_type=line_type,
+                           marker_type=marker_type,
+                           marker_size=marker_size,
+                           vector_rotate=vector_rotate,
+                           gap_fraction=gap_fraction)
+
+    def genPlotImage(self, timespan, plotname, plotgen_ts, img_file, sig=None):
+        """Generate a single plot image, saving it to img_file.
+
+        Returns the number of images generated (one on success, zero if the
+        image could not be saved)."""
+
+        # Everything about this plot was resolved when the job was compiled:
+        job = self._plot_jobs[(timespan, plotname)]
+        plot_options = job.plot_options
+
+        # Create the subdirectory that the image is to be put in, but only
+        # bother the filesystem the first time we see it.
+        # Wrap in a try block in case it already exists.
+        img_dir = os.path.dirname(img_file)
+        if img_dir not in self._dirs_made:
+            try:
+                os.makedirs(img_dir)
+            except OSError:
+                pass
+            self._dirs_made.add(img_dir)
+
+        # Create a new instance of a time plot and start adding to it
+        plot = weeplot.genplot.TimePlot(plot_options)
+
+        # Calculate a suitable min, max time for the requested time.
+        (minstamp, maxstamp, timeinc) = weeplot.utilities.scaletime(plotgen_ts - int(plot_options.get('time_length', 86400)), plotgen_ts)
+        # Override the x interval if the user has given an explicit interval:
+        timeinc_user = to_int(plot_options.get('x_interval'))
+        if timeinc_user is not None:
+            timeinc = timeinc_user
+        plot.setXScaling((minstamp, maxstamp, timeinc))
+
+        # Set the y-scaling, using any user-supplied hints:
+        plot.setYScaling(weeutil.weeutil.convertToFloat(plot_options.get('yscale', ['None', 'None', 'None'])))
+
+        # Get a suitable bottom label:
+        bottom_label_format = plot_options.get('bottom_label_format', '%m/%d/%y %H:%M')
+        plot.setBottomLabel(_bottom_label(bottom_label_format, plotgen_ts))
+
+        # Set day/night display
+        plot.setLocation(self.stn_info.latitude_f, self.stn_info.longitude_f)
+        plot.setDayNight(to_bool(plot_options.get('show_daynight', False)),
+                         _tobgr(plot_options.get('daynight_day_color', '0xffffff')),
+                         _tobgr(plot_options.get('daynight_night_color', '0xf0f0f0')),
+                         _tobgr(plot_options.get('daynight_edge_color', '0xefefef')))
+
+        # The line options were already resolved at compile time. Group the
+        # lines sharing a (binding, aggregation) signature, so each group can
+        # be fetched with a single scan:
+        fetch_groups = {}
+        for cfg in job.line_cfgs:
+            fetch_groups.setdefault((cfg.binding, cfg.aggregate_type, cfg.aggregate_interval),
+                                    []).append(cfg.var_type)
+
+        # Now its time to hit the database: one batched query per group. The
+        # DBBinder caches the manager lookup internally.
+        vectors = {}
+        for (binding, aggregate_type, aggregate_interval) in fetch_groups:
+            archive = self.db_binder.get_manager(binding)
+            results = archive.getSqlVectorsMulti(
+                (minstamp, maxstamp),
+                fetch_groups[(binding, aggregate_type, aggregate_interval)],
+                aggregate_type=aggregate_type,
+                aggregate_interval=aggregate_interval)
+            for var_type in results:
+                vectors[(binding, aggregate_type, aggregate_interval, var_type)] = results[var_type]
+
+        # Loop over each line to be added to the plot.
+        for cfg in job.line_cfgs:
+
+            var_type = cfg.var_type
+            aggregate_type = cfg.aggregate_type
+            aggregate_interval = cfg.aggregate_interval
+
+            (start_vec_t, stop_vec_t, data_vec_t) = \
+                    vectors[(cfg.binding, aggregate_type, aggregate_interval, var_type)]
+
+            if weewx.debug:
+                assert(len(start_vec_t) == len(stop_vec_t))
+
+            # A sensor that has gone offline produces a vector of all Nones.
+            # Don't bother converting and rendering such dead lines. The scan
+            # stops at the first good sample, so healthy lines pay almost
+            # nothing for the check.
+            if not any(v is not None for v in data_vec_t[0]):
+                syslog.syslog(syslog.LOG_DEBUG, "imagegenerator: No data for type '%s' in plot '%s'; line skipped" % (var_type, plotname))
+                continue
+
+            # Get the type of plot ("bar', 'line', or 'vector')
+            plot_type = cfg.plot_type
+
+            # Do any necessary unit conversions:
+            new_start_vec_t = self.converter.convert(start_vec_t)
+            new_stop_vec_t  = self.converter.convert(stop_vec_t)
+            new_data_vec_t = self.converter.convert(data_vec_t)
+
+            if aggregate_type and aggregate_type.lower() in ('avg', 'max', 'min') and plot_type != 'bar':
+                # Put the point in the middle of the aggregate_interval for
+                # these aggregation types. Timestamps are in seconds in any
+                # unit system, so shifting after the conversion is safe, and
+                # avoids allocating an extra pair of intermediate tuples.
+                half_interval = aggregate_interval / 2.0
+                if np is not None:
+                    # A single C-level subtract over the whole vector:
+                    new_start_vec_t = ValueTuple(np.asarray(new_start_vec_t[0], dtype=np.float64) - half_interval,
+                                                 new_start_vec_t[1], new_start_vec_t[2])
+                    new_stop_vec_t = ValueTuple(np.asarray(new_stop_vec_t[0], dtype=np.float64) - half_interval,
+                                                new_stop_vec_t[1], new_stop_vec_t[2])
+                else:
+                    new_start_vec_t = ValueTuple([x - half_interval for x in new_start_vec_t[0]],
+                                                 new_start_vec_t[1], new_start_vec_t[2])
+                    new_stop_vec_t = ValueTuple([x - half_interval for x in new_stop_vec_t[0]],
+                                                new_stop_vec_t[1], new_stop_vec_t[2])
+
+            # Add a unit label. NB: all will get overwritten except the
+            # last. Get the label from the configuration dictionary.
+            plot.setUnitLabel(cfg.unit_label)
+
+            # The bar width vector has to wait until the time vectors are in
+            # hand, so it is the one option not resolved by the line config:
+            interval_vec = None
+            if plot_type == 'bar':
+                if np is not None:
+                    interval_vec = np.asarray(new_stop_vec_t.value, dtype=np.float64) \
+                        - np.asarray(new_start_vec_t.value, dtype=np.float64)
+                else:
+                    interval_vec = [x[1] - x[0]for x in zip(new_start_vec_t.value, new_stop_vec_t.value)]
+
+            # Standardize on a typed, contiguous array for the x vector, so
+            # downstream rendering iterates machine floats instead of boxed
+            # Python objects. The y vector may hold None markers for missing
+            # data, so it has to stay as delivered.
+            x_vec = new_stop_vec_t[0]
+            if np is not None and not isinstance(x_vec, np.ndarray):
+                x_vec = np.asarray(x_vec, dtype=np.float64)
+
+            # Add the line to the emerging plot:
+            plot.addLine(weeplot.genplot.PlotLine(
+                x_vec, new_data_vec_t[0],
+                label         = cfg.label,
+                color         = cfg.color,
+                fill_color    = cfg.fill_color,
+                width         = cfg.width,
+                plot_type     = plot_type,
+                line_type     = cfg.line_type,
+                marker_type   = cfg.marker_type,
+                marker_size   = cfg.marker_size,
+                bar_width     = interval_vec,
+                vector_rotate = cfg.vector_rotate,
+                gap_fraction  = cfg.gap_fraction))
+
+        # OK, the plot is ready. Render it onto an image
+        image = plot.render()
+
+        # How hard zlib should squeeze the PNG. The default of 1 is ~3-5x
+        # faster than PIL's default level of 6, at a cost of ~15% larger
+        # files -- the right trade for images that get regenerated every few
+        # minutes. Dial it up in the skin if file size matters more.
+        compress_level = to_int(plot_options.get('png_compress_level', 1))
+
+        try:
+            # Now save the image. Encode into memory first: that way the
+            # write can be skipped altogether when the bytes are identical to
+            # the last render, and the write-then-rename publishes the file
+            # atomically, so a webserver can never read a partial image.
+            buf = io.BytesIO()
+            image.save(buf, format='PNG', optimize=False,
+                       compress_level=compress_level)
+            png_bytes = buf.getvalue()
+            png_hash = hashlib.md5(png_bytes).digest()
+            if _last_png_hash.get(img_file) == png_hash and os.path.exists(img_file):
+                # Same bytes as last time. Just freshen the mtime, which the
+                # staleness checks depend on.
+                os.utime(img_file, None)
+            else:
+                tmp_file = img_file + '.tmp'
+                with open(tmp_file, 'wb') as png_fd:
+                    png_fd.write(png_bytes)
+                os.rename(tmp_file, img_file)
+                _last_png_hash[img_file] = png_hash
+        except (IOError, OSError) as e:
+            syslog.syslog(syslog.LOG_CRIT, "imagegenerator: Unable to save to file '%s' %s:" % (img_file, e))
+            # Don't leave a partial temporary file behind for the uploading
+            # generators to find:
+            try:
+                os.unlink(img_file + '.tmp')
+            except OSError:
+                pass
+            return 0
+        if sig:
+            # Remember what went into this render, so an identical run can be
+            # skipped entirely. Write-then-rename keeps the update atomic,
+            # and the cache directory keeps the sidecars out of HTML_ROOT.
+            try:
+                if self._sig_dir not in self._dirs_made:
+                    try:
+                        os.makedirs(self._sig_dir)
+                    except OSError:
+                        pass
+                    self._dirs_made.add(self._sig_dir)
+                sig_file = self._sig_path(img_file)
+                tmp_file = sig_file + '.tmp'
+                with open(tmp_file, 'w') as sf:
+                    sf.write(sig)
+                os.rename(tmp_file, sig_file)
+            except (IOError, OSError):
+                pass
+        return 1
+
 def skipThisPlot(time_ts, aggregate_interval, img_file):
     """A plot can be skipped if it was generated recently and has not changed.
     This happens if the time since the plot was generated is less than the
     aggregation interval."""
 
     # Images without an aggregation interval have to be plotted every time.
-    # Also, the image definitely has to be generated if it doesn't exist.
-    if aggregate_interval is None or not os.path.exists(img_file):
+    if aggregate_interval is None:
+        return False
+
+    # One stat call answers both "does it exist?" and "how old is it?":
+    try:
+        stat_result = os.stat(img_file)
+    except OSError:
+        # The image definitely has to be generated if it doesn't exist.
         return False
 
     # If its a very old image, then it has to be regenerated
-    if time_ts - os.stat(img_file).st_mtime >= aggregate_interval:
+    if time_ts - stat_result.st_mtime >= aggregate_interval:
         return False
 
     # Finally, if we're on an aggregation boundary, regenerate.
-    time_dt = datetime.datetime.fromtimestamp(time_ts)
-    tdiff = time_dt -  time_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-    return abs(tdiff.seconds % aggregate_interval) > 1
+    tdiff = time_ts - _midnight_ts(time_ts)
+    return abs(tdiff % aggregate_interval) > 1
+
+def _midnight_ts(time_ts):
+    """Return the local midnight preceding time_ts, as a timestamp.
+
+    Memoized, because the same time_ts gets passed in for every plot of a
+    report run. Plain integer arithmetic on the struct_time avoids building
+    datetime objects per plot."""
+    try:
+        return _midnight_ts.cache[time_ts]
+    except KeyError:
+        pass
+    lt = time.localtime(time_ts)
+    midnight = time_ts - lt.tm_hour * 3600 - lt.tm_min * 60 - lt.tm_sec
+    if len(_midnight_ts.cache) > 64:
+        _midnight_ts.cache.clear()
+    _midnight_ts.cache[time_ts] = midnight
+    return midnight
+_midnight_ts.cache = {}
@@ -661,6 +661,58 @@ class Manager(object):
                 weewx.units.ValueTuple(stop_vec, time_type, time_group),
                 weewx.units.ValueTuple(data_vec, data_type, data_group))
 
+    def getSqlVectorsMulti(self, timespan, obs_type_list,
+                           aggregate_type=None,
+                           aggregate_interval=None):
+        """Get time and (possibly aggregated) data vectors for several
+        observation types, sharing a single table scan where possible.
+
+        All the observation types must share the same timespan, aggregation
+        type, and aggregation interval. Observation types that need special
+        treatment (the extended wind types, or the aggregations 'last' and
+        'cumulative', whose SQL cannot be combined with others) quietly fall
+        back on individual queries.
+
+        timespan: The timespan over which the aggregation is to be done.
+
+        obs_type_list: A sequence of observation types to be retrieved.
+
+        aggregate_type: None if no aggregation is desired, otherwise the type
+        of aggregation (e.g., 'sum', 'avg', etc.)  Default: None (no aggregation)
+
+        aggregate_interval: None if no aggregation is desired, otherwise
+        this is the time interval over which a result will be aggregated.
+        Required if aggregate_type is non-None.
+        Default: None (no aggregation)
+
+        returns: a dictionary. Each key is an observation type; each value is
+        the same 3-way tuple of value tuples returned by getSqlVectors for
+        that type."""
+
+        windvec_types = ('windvec', 'windgustvec')
+        special_aggregates = ('last', 'cumulative')
+
+        results = {}
+        # Separate out the types that can share a scan from the ones that
+        # have to be queried individually:
+        simple_types = []
+        for obs_type in obs_type_list:
+            if obs_type in windvec_types or \
+                    (aggregate_type and aggregate_type.lower() in special_aggregates):
+                results[obs_type] = self.getSqlVectors(timespan, obs_type,
+                                                       aggregate_type, aggregate_interval)
+            elif obs_type not in simple_types:
+                simple_types.append(obs_type)
+
+        if len(simple_types) == 1:
+            # Only one column. No point in the multi-column statement.
+            results[simple_types[0]] = self._getSqlVectors(timespan, simple_types[0],
+                                                           aggregate_type, aggregate_interval)
+        elif simple_types:
+            results.update(self._getSqlVectorsMulti(timespan, simple_types,
+                                                    aggregate_type, aggregate_interval))
+        return results
+
     def _check_unit_system(self, unit_system):
         """ Check to make sure a unit system is the same as what's already in use in the database."""
 
@@ -803,9 +855,102 @@ class Manager(object):
         (time_type, time_group) = weewx.units.getStandardUnitType(std_unit_system, 'dateTime')
         (data_type, data_group) = weewx.units.getStandardUnitType(std_unit_system, sql_type, aggregate_type)
         return (ValueTuple(start_vec, time_type, time_group),
-                ValueTuple(stop_vec, time_type, time_group), 
+                ValueTuple(stop_vec, time_type, time_group),
                 ValueTuple(data_vec, data_type, data_group))
 
+    def _getSqlVectorsMulti(self, timespan, sql_type_list,
+                            aggregate_type=None,
+                            aggregate_interval=None):
+        """Get time and (possibly aggregated) data vectors for several
+        database columns with a single table scan.
+
+        Same as _getSqlVectors, except that all the requested columns are
+        fetched (or aggregated) in one SELECT statement, amortizing query
+        planning and the table scan across the columns. The aggregation type,
+        if any, must be a plain SQL aggregate ('avg', 'min', 'max', 'sum',
+        'count'); the 'last' and 'cumulative' aggregations are handled by the
+        caller with individual queries.
+
+        returns: a dictionary. Each key is a column name from sql_type_list;
+        each value is the 3-way tuple of value tuples that _getSqlVectors
+        would have returned for that column."""
+
+        startstamp, stopstamp = timespan
+        n = len(sql_type_list)
+        start_vecs = [list() for _i in range(n)]
+        stop_vecs  = [list() for _i in range(n)]
+        data_vecs  = [list() for _i in range(n)]
+        std_unit_system = None
+
+        _cursor=self.connection.cursor()
+        try:
+
+            if aggregate_type :
+
+                aggregate_type = aggregate_type.lower()
+
+                # Check to make sure we have everything:
+                if not aggregate_interval:
+                    raise weewx.ViolatedPrecondition("Aggregation interval missing")
+
+                agg_list = ', '.join("%s(%s)" % (aggregate_type, sql_type)
+                                     for sql_type in sql_type_list)
+                sql_str = "SELECT %s, MIN(usUnits), MAX(usUnits) FROM %s "\
+                    "WHERE dateTime > ? AND dateTime <= ?" % (agg_list, self.table_name)
+
+                for stamp in weeutil.weeutil.intervalgen(startstamp, stopstamp, aggregate_interval):
+                    _cursor.execute(sql_str, stamp)
+                    _rec = _cursor.fetchone()
+                    # A null MIN(usUnits) signifies an interval without any
+                    # records at all:
+                    if not _rec or _rec[n] is None:
+                        continue
+                    if std_unit_system:
+                        if not (std_unit_system == _rec[n] == _rec[n + 1]):
+                            raise weewx.UnsupportedFeature("Unit type cannot change "\
+                                                           "within a time interval (%s vs %s vs %s)." %
+                                                           (std_unit_system, _rec[n], _rec[n + 1]))
+                    else:
+                        std_unit_system = _rec[n]
+                    # Don't accumulate any results for a column where there
+                    # wasn't a record (signified by a null result):
+                    for i in range(n):
+                        if _rec[i] is not None:
+                            start_vecs[i].append(stamp.start)
+                            stop_vecs[i].append(stamp.stop)
+                            data_vecs[i].append(_rec[i])
+
+            else:
+                # No aggregation
+                sql_str = "SELECT dateTime, %s, usUnits, `interval` FROM %s "\
+                            "WHERE dateTime >= ? AND dateTime <= ?" % \
+                            (', '.join(sql_type_list), self.table_name)
+                for _rec in _cursor.execute(sql_str, (startstamp, stopstamp)):
+                    if std_unit_system:
+                        if std_unit_system != _rec[n + 1]:
+                            raise weewx.UnsupportedFeature("Unit type cannot change "\
+                                                           "within a time interval.")
+                    else:
+                        std_unit_system = _rec[n + 1]
+                    for i in range(n):
+                        start_vecs[i].append(_rec[0] - _rec[n + 2])
+                        stop_vecs[i].append(_rec[0])
+                        data_vecs[i].append(_rec[i + 1])
+        finally:
+            _cursor.close()
+
+        results = {}
+        for i, sql_type in enumerate(sql_type_list):
+            # A column that never contributed a value leaves its unit system
+            # undetermined, just as _getSqlVectors reports it:
+            col_unit_system = std_unit_system if data_vecs[i] else None
+            (time_type, time_group) = weewx.units.getStandardUnitType(col_unit_system, 'dateTime')
+            (data_type, data_group) = weewx.units.getStandardUnitType(col_unit_system, sql_type, aggregate_type)
+            results[sql_type] = (ValueTuple(start_vecs[i], time_type, time_group),
+                                 ValueTuple(stop_vecs[i], time_type, time_group),
+                                 ValueTuple(data_vecs[i], data_type, data_group))
+        return results
+
 
 def reconfig(old_db_dict, new_db_dict, new_unit_system=None, new_schema=None):
     """Copy over an old archive to a new one, using a provided schema."""
@@ -219,6 +219,36 @@ class Common(unittest.TestCase):
                 # Compare them.
                 self.assertAlmostEqual(expected_avg, barvec[2][0][irec])
 
+    def test_get_multi_vectors(self):
+        # Add a bunch of records
+        self.populate_database()
+
+        # A multi-column fetch must return exactly what the equivalent
+        # per-column fetches return. Include windSpeed, which holds no data,
+        # to exercise the None handling.
+        obs_types = ['barometer', 'outTemp', 'windSpeed']
+        with weewx.manager.Manager.open(self.archive_db_dict) as archive:
+            for (aggregate_type, aggregate_interval) in [(None, None),
+                                                         ('avg', 6 * interval),
+                                                         ('min', 6 * interval),
+                                                         ('max', 6 * interval),
+                                                         ('sum', 6 * interval)]:
+                multi = archive.getSqlVectorsMulti((start_ts, stop_ts), obs_types,
+                                                   aggregate_type=aggregate_type,
+                                                   aggregate_interval=aggregate_interval)
+                self.assertEqual(sorted(multi.keys()), sorted(obs_types))
+                for obs_type in obs_types:
+                    single = archive.getSqlVectors((start_ts, stop_ts), obs_type,
+                                                   aggregate_type=aggregate_type,
+                                                   aggregate_interval=aggregate_interval)
+                    self.assertEqual(multi[obs_type], single)
+
+            # A request for a single type takes a different code path. Check
+            # that it matches as well:
+            multi = archive.getSqlVectorsMulti((start_ts, stop_ts), ['barometer'])
+            self.assertEqual(multi['barometer'],
+                             archive.getSqlVectors((start_ts, stop_ts), 'barometer'))
+
     def test_update(self):
         # Add a bunch of records
         self.populate_database()
@@ -252,8 +282,9 @@ class TestMySQL(Common):
 
     
 def suite():
-    tests = ['test_no_archive', 'test_create_archive', 
-             'test_empty_archive', 'test_add_archive_records', 'test_get_records', 'test_update']
+    tests = ['test_no_archive', 'test_create_archive',
+             'test_empty_archive', 'test_add_archive_records', 'test_get_records',
+             'test_get_multi_vectors', 'test_update']
     return unittest.TestSuite(map(TestSqlite, tests) + map(TestMySQL, tests))
             
 if __name__ == '__main__':